@@ -625,7 +625,8 @@ class Aws(ResourceAdapter):
                 resourceAdapterProfile,
                 hardwareProfile,
                 softwareProfile,
-                adapter_args
+                adapter_args,
+                configDict=configDict
             )
             template_created = True
             launch_template_name = \
@@ -0,0 +1,499 @@
+# Copyright 2008-2018 Univa Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import itertools
+import os
+import re
+import threading
+
+import mock
+import pytest
+
+from tortuga.exceptions.validationError import ValidationError
+from tortuga.resources.types import ScaleSetResourceRequest
+from tortuga_kits.awsadapter.events.listeners import scalesets
+from tortuga_kits.awsadapter.events.listeners.scalesets import (
+    AwsScaleSetCreatedListener, AwsScaleSetDeletedListener,
+    AwsScaleSetUpdatedListener)
+
+
+def make_listener(cls):
+    # Listeners keep no per-instance state, so BaseListener's constructor
+    # is not needed to exercise them
+    return cls.__new__(cls)
+
+
+def make_ssr(**kwargs):
+    values = {
+        'id': 'ssr-1',
+        'resourceadapter_name': 'AWS',
+        'resourceadapter_profile_name': 'Default',
+        'hardwareprofile_name': 'hwp',
+        'softwareprofile_name': 'swp',
+        'min_nodes': 0,
+        'max_nodes': 10,
+        'desired_nodes': 1,
+        'adapter_arguments': {},
+    }
+    values.update(kwargs)
+    return ScaleSetResourceRequest(**values)
+
+
+def make_event(ssr_id='ssr-1', previous=None):
+    return mock.Mock(resourcerequest_id=ssr_id,
+                     previous_resourcerequest=previous)
+
+
+@pytest.fixture
+def store():
+    store = mock.Mock()
+    context = scalesets._ListenerContext(store=store, session=mock.Mock())
+    with mock.patch.object(scalesets, '_context', context):
+        yield store
+
+
+@pytest.fixture
+def adapter():
+    adapter = mock.Mock()
+    scalesets._adapter_cache.__dict__.clear()
+    with mock.patch.object(scalesets, 'get_api', return_value=adapter):
+        yield adapter
+    scalesets._adapter_cache.__dict__.clear()
+
+
+@pytest.fixture
+def coalescer():
+    coalescer = scalesets._UpdateCoalescer(0.5)
+    with mock.patch.object(coalescer, '_start_worker'), \
+            mock.patch.object(scalesets, '_update_coalescer', coalescer):
+        yield coalescer
+
+
+@pytest.fixture
+def recent_creates():
+    recent_creates = collections.OrderedDict()
+    with mock.patch.object(scalesets, '_recent_creates', recent_creates):
+        yield recent_creates
+
+
+def run_updates(store, *ssrs):
+    listener = make_listener(AwsScaleSetUpdatedListener)
+    events = []
+    for ssr in ssrs:
+        store.get.return_value = ssr
+        event = make_event(ssr.id, previous={'desired_nodes': len(events)})
+        events.append(event)
+        listener.run(event)
+    return events
+
+
+def test_update_burst_is_coalesced(store, adapter, coalescer):
+    """A burst of updates results in a single update with the latest counts"""
+    run_updates(store,
+                make_ssr(desired_nodes=1),
+                make_ssr(desired_nodes=2),
+                make_ssr(min_nodes=1, max_nodes=5, desired_nodes=3))
+
+    adapter.update_scale_set.assert_not_called()
+
+    coalescer.flush_due(now=float('inf'))
+
+    adapter.update_scale_set.assert_called_once_with(
+        name='ssr-1',
+        resourceAdapterProfile='Default',
+        minCount=1,
+        maxCount=5,
+        desiredCount=3,
+        adapter_args={}
+    )
+
+
+def test_update_is_rescheduled(store, adapter, coalescer):
+    """Each update in a burst pushes back the deadline of the pending one"""
+    with mock.patch.object(scalesets.time, 'monotonic',
+                           side_effect=[100.0, 100.4]):
+        run_updates(store, make_ssr(desired_nodes=1),
+                    make_ssr(desired_nodes=2))
+
+    coalescer.flush_due(now=100.6)
+    adapter.update_scale_set.assert_not_called()
+
+    coalescer.flush_due(now=100.9)
+    adapter.update_scale_set.assert_called_once()
+    assert adapter.update_scale_set.call_args[1]['desiredCount'] == 2
+
+
+def test_update_burst_is_applied_after_max_wait(store, adapter, coalescer):
+    """A steady stream of updates is not held back past the max wait"""
+    times = [100.0 + 0.3 * i for i in range(10)]
+    with mock.patch.object(scalesets.time, 'monotonic', side_effect=times):
+        run_updates(store, *[make_ssr(desired_nodes=i)
+                             for i in range(len(times))])
+
+    # The last update came in at 102.7, but the burst started at 100.0
+    coalescer.flush_due(now=101.9)
+    adapter.update_scale_set.assert_not_called()
+
+    coalescer.flush_due(now=102.0)
+    adapter.update_scale_set.assert_called_once()
+    assert adapter.update_scale_set.call_args[1]['desiredCount'] == 9
+
+
+def test_update_after_max_wait_starts_new_burst(store, adapter, coalescer):
+    with mock.patch.object(scalesets.time, 'monotonic',
+                           side_effect=[100.0, 100.3, 102.5]):
+        run_updates(store, make_ssr(desired_nodes=1),
+                    make_ssr(desired_nodes=2))
+        coalescer.flush_due(now=100.8)
+        run_updates(store, make_ssr(desired_nodes=3))
+
+    coalescer.flush_due(now=102.9)
+    assert adapter.update_scale_set.call_count == 1
+
+    coalescer.flush_due(now=103.0)
+    assert adapter.update_scale_set.call_count == 2
+    assert adapter.update_scale_set.call_args[1]['desiredCount'] == 3
+
+
+def test_updates_for_different_scale_sets_are_not_coalesced(
+        store, adapter, coalescer):
+    run_updates(store, make_ssr(id='ssr-1'), make_ssr(id='ssr-2'))
+
+    coalescer.flush_due(now=float('inf'))
+
+    names = [call[1]['name']
+             for call in adapter.update_scale_set.call_args_list]
+    assert names == ['ssr-1', 'ssr-2']
+
+
+def test_failed_update_rolls_back_first_event(store, adapter, coalescer):
+    """A failed coalesced update rolls back to the state before the burst"""
+    adapter.update_scale_set.side_effect = Exception('update failed')
+
+    with mock.patch.object(
+            AwsScaleSetUpdatedListener, 'get_previous_scale_set_request',
+            side_effect=lambda event: event.previous_resourcerequest):
+        events = run_updates(store, make_ssr(desired_nodes=1),
+                             make_ssr(desired_nodes=2),
+                             make_ssr(desired_nodes=3))
+
+        coalescer.flush_due(now=float('inf'))
+
+    store.rollback.assert_called_once_with(
+        events[0].previous_resourcerequest)
+
+
+def test_flushed_update_is_not_applied_again(store, adapter, coalescer):
+    run_updates(store, make_ssr())
+
+    coalescer.flush_due(now=float('inf'))
+    coalescer.flush_due(now=float('inf'))
+    coalescer.drain()
+
+    adapter.update_scale_set.assert_called_once()
+
+
+def test_update_without_delay_is_applied_immediately(store, adapter,
+                                                     coalescer):
+    coalescer.delay = 0
+
+    run_updates(store, make_ssr(desired_nodes=1), make_ssr(desired_nodes=2))
+
+    assert adapter.update_scale_set.call_count == 2
+
+
+def test_delete_cancels_pending_update(store, adapter, coalescer):
+    """A pending update is dropped when its scale set is deleted"""
+    ssr = make_ssr()
+    run_updates(store, ssr)
+
+    with mock.patch.object(AwsScaleSetDeletedListener,
+                           'get_previous_scale_set_request',
+                           return_value=ssr):
+        make_listener(AwsScaleSetDeletedListener).run(make_event())
+
+    coalescer.flush_due(now=float('inf'))
+
+    adapter.delete_scale_set.assert_called_once()
+    adapter.update_scale_set.assert_not_called()
+    store.rollback.assert_not_called()
+
+
+def start_blocked_flush(store, adapter, coalescer, blocked_id):
+    """
+    Schedule updates for ssr-1 and ssr-2 and start applying the one for
+    `blocked_id`, which blocks inside update_scale_set() until released.
+    """
+    started = threading.Event()
+    release = threading.Event()
+
+    def update_scale_set(**kwargs):
+        if kwargs['name'] == blocked_id:
+            started.set()
+            release.wait(timeout=5)
+
+    adapter.update_scale_set.side_effect = update_scale_set
+
+    # Only the update for blocked_id is due when the flush runs
+    scheduled_at = {'ssr-1': 100.0, 'ssr-2': 100.0}
+    scheduled_at[blocked_id] = 99.0
+    with mock.patch.object(scalesets.time, 'monotonic',
+                           side_effect=[scheduled_at['ssr-1'],
+                                        scheduled_at['ssr-2']]):
+        run_updates(store, make_ssr(id='ssr-1'), make_ssr(id='ssr-2'))
+
+    flush = threading.Thread(target=coalescer.flush_due,
+                             kwargs={'now': 99.6})
+    flush.start()
+    assert started.wait(timeout=5)
+
+    return flush, release
+
+
+def test_cancel_does_not_wait_for_other_updates(store, adapter, coalescer):
+    """Cancelling one scale set does not wait for updates of others"""
+    flush, release = start_blocked_flush(store, adapter, coalescer, 'ssr-2')
+    try:
+        cancel = threading.Thread(target=coalescer.cancel, args=('ssr-1',))
+        cancel.start()
+        cancel.join(timeout=1)
+
+        assert not cancel.is_alive()
+    finally:
+        release.set()
+        flush.join(timeout=5)
+
+    coalescer.flush_due(now=float('inf'))
+
+    names = [call[1]['name']
+             for call in adapter.update_scale_set.call_args_list]
+    assert names == ['ssr-2']
+
+
+def test_cancel_waits_for_update_being_applied(store, adapter, coalescer):
+    """Cancelling waits for an update of the same scale set in flight"""
+    flush, release = start_blocked_flush(store, adapter, coalescer, 'ssr-1')
+    try:
+        cancel = threading.Thread(target=coalescer.cancel, args=('ssr-1',))
+        cancel.start()
+        cancel.join(timeout=0.2)
+
+        assert cancel.is_alive()
+    finally:
+        release.set()
+        flush.join(timeout=5)
+
+    cancel.join(timeout=5)
+    assert not cancel.is_alive()
+
+
+def test_drain_applies_pending_updates(store, adapter, coalescer):
+    run_updates(store, make_ssr(desired_nodes=1))
+
+    coalescer.drain()
+
+    adapter.update_scale_set.assert_called_once()
+
+    # Updates arriving after shutdown has started are applied right away
+    run_updates(store, make_ssr(desired_nodes=2))
+
+    assert adapter.update_scale_set.call_count == 2
+
+
+def test_worker_applies_update(store, adapter):
+    coalescer = scalesets._UpdateCoalescer(0.01)
+    applied = threading.Event()
+    adapter.update_scale_set.side_effect = lambda **kwargs: applied.set()
+
+    with mock.patch.object(scalesets, '_update_coalescer', coalescer), \
+            mock.patch.object(scalesets.atexit, 'register'):
+        run_updates(store, make_ssr())
+
+        assert applied.wait(timeout=5)
+
+        coalescer.drain()
+
+    adapter.update_scale_set.assert_called_once()
+
+
+@pytest.mark.parametrize('value,expected', [
+    (None, 0.5),
+    ('2', 2.0),
+    ('0', 0.0),
+    ('not a number', 0.5),
+])
+def test_get_update_delay(value, expected):
+    environ = {}
+    if value is not None:
+        environ['TORTUGA_AWS_SCALE_SET_UPDATE_DELAY'] = value
+
+    with mock.patch.dict(os.environ, environ):
+        if value is None:
+            os.environ.pop('TORTUGA_AWS_SCALE_SET_UPDATE_DELAY', None)
+
+        assert scalesets._get_update_delay() == expected
+
+
+@pytest.mark.parametrize('value,expected', [
+    (None, 2.0),
+    ('5', 5.0),
+    ('not a number', 2.0),
+])
+def test_get_update_max_wait(value, expected):
+    environ = {}
+    if value is not None:
+        environ['TORTUGA_AWS_SCALE_SET_UPDATE_MAX_WAIT'] = value
+
+    with mock.patch.dict(os.environ, environ):
+        if value is None:
+            os.environ.pop('TORTUGA_AWS_SCALE_SET_UPDATE_MAX_WAIT', None)
+
+        assert scalesets._get_update_max_wait(0.5) == expected
+
+
+def test_duplicate_create_is_ignored(store, adapter, recent_creates):
+    """A redelivered create event does not reach AWS again"""
+    store.get.return_value = make_ssr()
+    listener = make_listener(AwsScaleSetCreatedListener)
+
+    listener.run(make_event())
+    listener.run(make_event())
+
+    adapter.create_scale_set.assert_called_once()
+
+
+def test_failed_create_can_be_retried(store, adapter, recent_creates):
+    store.get.return_value = make_ssr()
+    adapter.create_scale_set.side_effect = [Exception('create failed'), None]
+    listener = make_listener(AwsScaleSetCreatedListener)
+
+    listener.run(make_event())
+
+    store.delete.assert_called_once_with('ssr-1')
+    assert 'ssr-1' not in recent_creates
+
+    listener.run(make_event())
+
+    assert adapter.create_scale_set.call_count == 2
+    assert 'ssr-1' in recent_creates
+
+
+def test_create_without_adapter_can_be_retried(store, adapter,
+                                               recent_creates):
+    store.get.return_value = make_ssr()
+    listener = make_listener(AwsScaleSetCreatedListener)
+
+    with mock.patch.object(scalesets, 'get_api',
+                           side_effect=Exception('not installed')):
+        listener.run(make_event())
+
+    store.delete.assert_called_once_with('ssr-1')
+    assert 'ssr-1' not in recent_creates
+
+    listener.run(make_event())
+
+    adapter.create_scale_set.assert_called_once()
+
+
+def test_recent_creates_are_evicted(recent_creates):
+    with mock.patch.object(scalesets, 'RECENT_CREATES_MAX', 2):
+        assert scalesets._mark_created('ssr-1')
+        assert scalesets._mark_created('ssr-2')
+        assert scalesets._mark_created('ssr-3')
+
+        assert list(recent_creates) == ['ssr-2', 'ssr-3']
+        assert scalesets._mark_created('ssr-1')
+        assert not scalesets._mark_created('ssr-3')
+
+
+@pytest.mark.parametrize('resourceadapter_name,valid', [
+    ('AWS', True),
+    ('gce', False),
+])
+def test_get_previous_scale_set_request(resourceadapter_name, valid):
+    """The previous request survives a round trip through its schema"""
+    ssr = make_ssr(resourceadapter_name=resourceadapter_name,
+                   desired_nodes=3)
+    schema = ScaleSetResourceRequest.get_schema_class()()
+    event = make_event(previous=schema.dump(ssr).data)
+
+    listener = make_listener(AwsScaleSetUpdatedListener)
+    result = listener.get_previous_scale_set_request(event)
+
+    if not valid:
+        assert result is None
+        return
+
+    assert type(result) is ScaleSetResourceRequest
+    assert result.id == ssr.id
+    assert result.resourceadapter_name == 'AWS'
+    assert result.resourceadapter_profile_name == \
+        ssr.resourceadapter_profile_name
+    assert result.desired_nodes == 3
+
+
+def expected_validation_error(instance_template_name, hardwareprofile_name,
+                              softwareprofile_name, resourceadapter_name,
+                              resourceadapter_profile_name):
+    # The rules as written before validation used a lookup table. A
+    # template request is accepted without an adapter name or profile.
+    if instance_template_name:
+        if hardwareprofile_name or softwareprofile_name:
+            return ('Specify either an instance template name or a '
+                    'hardware profile and software profile to create a '
+                    'scale set, not both.')
+    elif not (hardwareprofile_name and softwareprofile_name):
+        return ('Must specify both a hardware profile and a software '
+                'profile to create a scale set.')
+    elif not resourceadapter_name:
+        return 'Scale set creation requires a resource adapter name.'
+    elif not resourceadapter_profile_name:
+        return ('Scale set creation requires a resource adapter '
+                'profile name.')
+
+    return None
+
+
+@pytest.mark.parametrize('fields',
+                         list(itertools.product((False, True), repeat=5)))
+def test_validate_scale_set_request(fields):
+    expected = expected_validation_error(*fields)
+
+    assert scalesets._SCALE_SET_VALIDATION_ERRORS[fields] == expected
+
+    names = ['instance_template_name', 'hardwareprofile_name',
+             'softwareprofile_name', 'resourceadapter_name',
+             'resourceadapter_profile_name']
+    ssr = make_ssr(**{
+        name: 'value' if is_set else None
+        for name, is_set in zip(names, fields)
+    })
+    listener = make_listener(AwsScaleSetCreatedListener)
+
+    if expected is None:
+        listener._validate_scale_set_request(ssr)
+    else:
+        with pytest.raises(ValidationError, match=re.escape(expected)):
+            listener._validate_scale_set_request(ssr)
+
+
+def test_validate_template_request_without_adapter():
+    ssr = make_ssr(instance_template_name='template',
+                   hardwareprofile_name=None,
+                   softwareprofile_name=None,
+                   resourceadapter_name=None,
+                   resourceadapter_profile_name=None)
+
+    make_listener(AwsScaleSetCreatedListener)._validate_scale_set_request(ssr)
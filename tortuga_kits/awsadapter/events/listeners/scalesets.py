@@ -11,8 +11,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import atexit
+import collections
+import itertools
 import logging
-from typing import Optional
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, NamedTuple, Optional, Tuple
 
 import botocore.exceptions
 
@@ -30,29 +37,385 @@ from tortuga.resources.manager import ResourceRequestStoreManager
 from tortuga.resourceAdapter.resourceAdapterFactory import get_api
 from tortuga.resourceAdapter.resourceAdapter import ResourceAdapter
 
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from tortuga.web_service.database import dbm
 
 logger = logging.getLogger(__name__)
 
+#
+# Built once at import time and shared by all listener instances
+#
+_SessionFactory = sessionmaker(bind=dbm.engine)
+
+#
+# The resource adapter is cached per thread: the adapter keeps a reference
+# to the current database session, so it cannot be shared between threads
+#
+_adapter_cache = threading.local()
+
+
+def _get_seconds_setting(name: str, default: float) -> float:
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.error('Invalid %s value: %s', name, value)
+        return default
+
+
+def _get_update_delay() -> float:
+    return _get_seconds_setting('TORTUGA_AWS_SCALE_SET_UPDATE_DELAY', 0.5)
+
+
+def _get_update_max_wait(delay: float) -> float:
+    return _get_seconds_setting('TORTUGA_AWS_SCALE_SET_UPDATE_MAX_WAIT',
+                                UPDATE_MAX_WAIT_FACTOR * delay)
+
+
+#
+# Bursts of update events for the same scale set are coalesced into a
+# single update, applied once no new update has arrived for this many
+# seconds. A value of 0 disables coalescing.
+#
+UPDATE_DELAY = _get_update_delay()
+
+#
+# Longest time an update is held back while a burst keeps going, counted
+# from the first update of the burst. Defaults to a few times the delay.
+#
+UPDATE_MAX_WAIT_FACTOR = 4
+UPDATE_MAX_WAIT = _get_update_max_wait(UPDATE_DELAY)
+
+
+class _PendingUpdate(NamedTuple):
+    listener: 'AwsScaleSetUpdatedListener'
+    ssr: ScaleSetResourceRequest
+    first_event: ResourceRequestUpdated
+    burst_start: float
+    deadline: float
+
+
+class _UpdateCoalescer:
+    """
+    Holds scale set updates until no newer update for the same resource
+    request has arrived for `delay` seconds, then applies the most recent
+    one. An update is never held for more than `max_wait` seconds after the
+    first update of its burst, so a steady stream of updates still reaches
+    AWS.
+
+    All updates are applied by a single worker thread, which keeps updates
+    for a scale set in order and lets the per-thread adapter and schema
+    caches be reused between updates.
+    """
+    def __init__(self, delay: float, max_wait: Optional[float] = None):
+        self.delay = delay
+        self.max_wait = max_wait if max_wait is not None \
+            else UPDATE_MAX_WAIT_FACTOR * delay
+        self._pending: Dict[str, _PendingUpdate] = {}
+        self._cond = threading.Condition()
+        #
+        # Ids of updates taken off the pending list and being applied, so
+        # cancel() can wait for the update of its own scale set only
+        #
+        self._in_flight: 'collections.Counter[str]' = collections.Counter()
+        self._worker: Optional[threading.Thread] = None
+        self._stopping = False
+
+    def schedule(self, listener: 'AwsScaleSetUpdatedListener',
+                 ssr: ScaleSetResourceRequest,
+                 event: ResourceRequestUpdated):
+        with self._cond:
+            if self._stopping:
+                #
+                # Shutting down: nothing is left to apply a pending update,
+                # so apply this one right away
+                #
+                update = _PendingUpdate(listener, ssr, event, 0, 0)
+                self._in_flight[ssr.id] += 1
+            else:
+                now = time.monotonic()
+                pending = self._pending.get(ssr.id)
+                #
+                # Keep the first event of the burst, so that a failed update
+                # rolls back to the state from before the burst began
+                #
+                if pending is None:
+                    first_event, burst_start = event, now
+                else:
+                    first_event, burst_start = \
+                        pending.first_event, pending.burst_start
+                deadline = min(now + self.delay,
+                               burst_start + self.max_wait)
+                self._pending[ssr.id] = _PendingUpdate(
+                    listener, ssr, first_event, burst_start, deadline)
+                self._start_worker()
+                self._cond.notify_all()
+                return
+
+        self._apply(update)
+
+    def cancel(self, ssr_id: str):
+        """
+        Drop the pending update for a resource request, if any. If an update
+        for it is currently being applied, wait for it to finish.
+        """
+        with self._cond:
+            self._pending.pop(ssr_id, None)
+            while self._in_flight[ssr_id]:
+                self._cond.wait()
+
+    def flush_due(self, now: Optional[float] = None):
+        """
+        Apply all pending updates whose delay has expired.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        while True:
+            with self._cond:
+                update = self._pop_due(now)
+            if update is None:
+                return
+            self._apply(update)
+
+    def drain(self):
+        """
+        Stop the worker thread and apply all pending updates immediately.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            worker = self._worker
+
+        if worker is not None:
+            worker.join()
+
+        self.flush_due(now=float('inf'))
+
+    def _pop_due(self, now: float) -> Optional[_PendingUpdate]:
+        """
+        Take the earliest due update off the pending list and mark it as
+        being applied. Must be called with the condition held.
+        """
+        due = [update for update in self._pending.values()
+               if update.deadline <= now]
+        if not due:
+            return None
+
+        update = min(due, key=lambda update: update.deadline)
+        del self._pending[update.ssr.id]
+        self._in_flight[update.ssr.id] += 1
+        return update
+
+    def _apply(self, update: _PendingUpdate):
+        try:
+            update.listener._update_scale_set(update.ssr, update.first_event)
+        except Exception:
+            logger.exception('Error applying scale set update: %s',
+                             update.ssr.id)
+        finally:
+            #
+            # The worker thread has its own scoped session, which must be
+            # removed here to return its connection to the pool
+            #
+            update.listener.close_session()
+
+            with self._cond:
+                self._in_flight[update.ssr.id] -= 1
+                if not self._in_flight[update.ssr.id]:
+                    del self._in_flight[update.ssr.id]
+                self._cond.notify_all()
+
+    def _start_worker(self):
+        if self._worker is not None:
+            return
+        #
+        # Non-daemon threads are joined before atexit handlers run, so the
+        # worker is a daemon thread and pending updates are instead applied
+        # by drain() at exit
+        #
+        self._worker = threading.Thread(target=self._run_worker,
+                                        name='aws-scale-set-updates',
+                                        daemon=True)
+        self._worker.start()
+        atexit.register(self.drain)
+
+    def _run_worker(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._pending:
+                        timeout = min(
+                            update.deadline
+                            for update in self._pending.values()
+                        ) - time.monotonic()
+                        if timeout <= 0:
+                            break
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+
+                if self._stopping:
+                    return
+
+            self.flush_due()
+
+
+_update_coalescer = _UpdateCoalescer(UPDATE_DELAY, UPDATE_MAX_WAIT)
+
+#
+# Schema instances are cached per thread: marshmallow keeps the errors of
+# the last load on the schema, so instances are not shared between threads
+#
+_schema_cache = threading.local()
+
+
+@lru_cache(maxsize=32)
+def _get_resource_request_class(resource_type: str):
+    return get_resource_request_class(resource_type)
+
+
+def _get_resource_request_schema(resource_type: str):
+    schemas = getattr(_schema_cache, 'schemas', None)
+    if schemas is None:
+        schemas = _schema_cache.schemas = {}
+
+    schema = schemas.get(resource_type)
+    if schema is None:
+        resource_request_class = _get_resource_request_class(resource_type)
+        schema = resource_request_class.get_schema_class()()
+        schemas[resource_type] = schema
+
+    return schema
+
+
+_ERR_TEMPLATE_AND_PROFILES = (
+    'Specify either an instance template name or a hardware profile and '
+    'software profile to create a scale set, not both.')
+_ERR_MISSING_PROFILES = ('Must specify both a hardware profile and a '
+                         'software profile to create a scale set.')
+_ERR_MISSING_ADAPTER_NAME = \
+    'Scale set creation requires a resource adapter name.'
+_ERR_MISSING_ADAPTER_PROFILE = \
+    'Scale set creation requires a resource adapter profile name.'
+
+
+def _get_scale_set_validation_error(instance_template_name: bool,
+                                    hardwareprofile_name: bool,
+                                    softwareprofile_name: bool,
+                                    resourceadapter_name: bool,
+                                    resourceadapter_profile_name: bool) \
+        -> Optional[str]:
+    if instance_template_name:
+        if hardwareprofile_name or softwareprofile_name:
+            return _ERR_TEMPLATE_AND_PROFILES
+    elif not (hardwareprofile_name and softwareprofile_name):
+        return _ERR_MISSING_PROFILES
+    elif not resourceadapter_name:
+        return _ERR_MISSING_ADAPTER_NAME
+    elif not resourceadapter_profile_name:
+        return _ERR_MISSING_ADAPTER_PROFILE
+
+    return None
+
+
+#
+# Validation result for every combination of set/unset scale set request
+# fields, computed once so validating a request is a single lookup
+#
+_SCALE_SET_VALIDATION_ERRORS: Dict[Tuple[bool, ...], Optional[str]] = {
+    key: _get_scale_set_validation_error(*key)
+    for key in itertools.product((False, True), repeat=5)
+}
+
+
+#
+# Ids of recently created scale sets, used to ignore redelivered create
+# events without another round-trip to AWS
+#
+RECENT_CREATES_MAX = 4096
+_recent_creates: 'collections.OrderedDict[str, None]' = \
+    collections.OrderedDict()
+_recent_creates_lock = threading.Lock()
+
+
+def _mark_created(ssr_id: str) -> bool:
+    """
+    Record a scale set create request.
+
+    :return: False if the request was already recorded
+    """
+    with _recent_creates_lock:
+        if ssr_id in _recent_creates:
+            return False
+        _recent_creates[ssr_id] = None
+        if len(_recent_creates) > RECENT_CREATES_MAX:
+            _recent_creates.popitem(last=False)
+    return True
+
+
+def _unmark_created(ssr_id: str):
+    with _recent_creates_lock:
+        _recent_creates.pop(ssr_id, None)
+
+
+class _ListenerContext(NamedTuple):
+    store: ResourceRequestStore
+    session: scoped_session
+
+
+#
+# Resources shared by all listener instances, created on first use. The
+# scoped session hands out one session per thread.
+#
+_context: Optional[_ListenerContext] = None
+_context_lock = threading.Lock()
+
 
 class AwsScaleSetListenerMixin:
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._store: ResourceRequestStore = ResourceRequestStoreManager.get()
-        Session = sessionmaker(bind=dbm.engine)
-        self.session = Session()
+    @classmethod
+    def _ctx(cls) -> _ListenerContext:
+        global _context
+
+        if _context is None:
+            with _context_lock:
+                if _context is None:
+                    _context = _ListenerContext(
+                        store=ResourceRequestStoreManager.get(),
+                        session=scoped_session(_SessionFactory)
+                    )
+
+        return _context
+
+    def close_session(self):
+        #
+        # Return the connection for the current thread to the pool. No
+        # session is created if the event never needed one.
+        #
+        self._ctx().session.remove()
 
     def get_resource_adapter(self) -> ResourceAdapter:
-        adapter = get_api('AWS')
-        adapter.session = self.session
+        adapter: Optional[ResourceAdapter] = getattr(
+            _adapter_cache, 'adapter', None)
+        if adapter is None:
+            adapter = get_api('AWS')
+            _adapter_cache.adapter = adapter
+        #
+        # Only check out a session when one is actually needed, so events
+        # that are rejected early never touch the connection pool
+        #
+        adapter.session = self._ctx().session()
         return adapter
 
     def is_valid_request(self, resource_request: BaseResourceRequest) -> bool:
         #
-        # Only ScaleSetResourceRequests are valid for these listeners
+        # Only ScaleSetResourceRequests are valid for these listeners. An
+        # exact type check is cheaper than isinstance() for the common case
+        # of rejecting other resource request types.
         #
-        if not isinstance(resource_request, ScaleSetResourceRequest):
+        if type(resource_request) is not ScaleSetResourceRequest:
             return False
         #
         # Only requests destined for AWS are valid for these listeners
@@ -69,7 +432,7 @@ class AwsScaleSetListenerMixin:
         #
         # Get the resource request
         #
-        rr = self._store.get(event.resourcerequest_id)
+        rr = self._ctx().store.get(event.resourcerequest_id)
         #
         # Validate the resource request
         #
@@ -85,15 +448,23 @@ class AwsScaleSetListenerMixin:
         #
         if not hasattr(event, 'previous_resourcerequest'):
             return None
+        rr_data = event.previous_resourcerequest
+        #
+        # Skip deserialization entirely for requests not destined for AWS.
+        # If the serialized data has no adapter name, leave the decision to
+        # the validation below.
+        #
+        resourceadapter_name = rr_data.get('resourceadapter_name')
+        if resourceadapter_name is not None and \
+                resourceadapter_name != 'AWS':
+            return None
         #
         # Deserialize the previous resource request
         #
-        rr_data = event.previous_resourcerequest
-        resource_request_class = get_resource_request_class(
-            rr_data['resource_type'])
-        schema_class = resource_request_class.get_schema_class()
-        unmarshalled = schema_class().load(event.previous_resourcerequest)
-        rr = resource_request_class(**unmarshalled.data)
+        resource_type = rr_data['resource_type']
+        schema = _get_resource_request_schema(resource_type)
+        unmarshalled = schema.load(rr_data)
+        rr = _get_resource_request_class(resource_type)(**unmarshalled.data)
         #
         # Validate the resource request
         #
@@ -108,6 +479,13 @@ class AwsScaleSetCreatedListener(AwsScaleSetListenerMixin, BaseListener):
     event_types = [ResourceRequestCreated]
 
     def run(self, event: ResourceRequestCreated):
+        try:
+            self._run(event)
+        finally:
+            self.close_session()
+
+    def _run(self, event: ResourceRequestCreated):
+        ctx = self._ctx()
         #
         # If no scale set for AWS, then ignore this event
         #
@@ -115,17 +493,24 @@ class AwsScaleSetCreatedListener(AwsScaleSetListenerMixin, BaseListener):
         if ssr is None:
             return
 
-        logger.warning('Scale set create request for AWS: %s', ssr.id)
+        logger.debug('Scale set create request for AWS: %s', ssr.id)
 
         # Validate scale set request
         self._validate_scale_set_request(ssr)
 
+        # Ignore redelivered events for a scale set already being created
+        if not _mark_created(ssr.id):
+            logger.debug('Ignoring duplicate scale set create request: %s',
+                         ssr.id)
+            return
+
         # Load the resource adapter for this request
         try:
             adapter = self.get_resource_adapter()
         except Exception as ex:
             logger.warning('Resource adapter is not installed: %s', ex)
-            self._store.delete(ssr.id)
+            _unmark_created(ssr.id)
+            ctx.store.delete(ssr.id)
             return
 
         try:
@@ -143,34 +528,33 @@ class AwsScaleSetCreatedListener(AwsScaleSetListenerMixin, BaseListener):
 
         except Exception as ex:
             logger.error("Error creating resource request: %s", ex)
-            self._store.delete(ssr.id)
+            _unmark_created(ssr.id)
+            ctx.store.delete(ssr.id)
 
     def _validate_scale_set_request(self, ssr: ScaleSetResourceRequest):
-        err_msg = None
-        if ssr.instance_template_name:
-            if (ssr.hardwareprofile_name or ssr.softwareprofile_name):
-                err_msg = ('Specify either an instance template name or a '
-                           'hardware profile and software profile to create a '
-                           'scale set, not both.')
-        elif not (ssr.hardwareprofile_name and ssr.softwareprofile_name):
-            err_msg = ('Must specify both a hardware profile and a software '
-                       'profile to create a scale set.')
-        elif not ssr.resourceadapter_name:
-            err_msg = 'Scale set creation requires a resource adapter name.'
-        elif not ssr.resourceadapter_profile_name:
-            err_msg = ('Scale set creation requires a resource adapter '
-                       'profile name.')
+        err_msg = _SCALE_SET_VALIDATION_ERRORS[(
+            bool(ssr.instance_template_name),
+            bool(ssr.hardwareprofile_name),
+            bool(ssr.softwareprofile_name),
+            bool(ssr.resourceadapter_name),
+            bool(ssr.resourceadapter_profile_name),
+        )]
 
         if err_msg:
             raise ValidationError(err_msg)
 
 
-
 class AwsScaleSetUpdatedListener(AwsScaleSetListenerMixin, BaseListener):
     name = 'aws-scale-set-updated-listener'
     event_types = [ResourceRequestUpdated]
 
     def run(self, event: ResourceRequestUpdated):
+        try:
+            self._run(event)
+        finally:
+            self.close_session()
+
+    def _run(self, event: ResourceRequestUpdated):
         #
         # If no scale set for AWS, then ignore this event
         #
@@ -178,7 +562,17 @@ class AwsScaleSetUpdatedListener(AwsScaleSetListenerMixin, BaseListener):
         if ssr is None:
             return
 
-        logger.warning('Scale set update request for AWS: %s', ssr.id)
+        logger.debug('Scale set update request for AWS: %s', ssr.id)
+
+        if _update_coalescer.delay <= 0:
+            self._update_scale_set(ssr, event)
+            return
+
+        _update_coalescer.schedule(self, ssr, event)
+
+    def _update_scale_set(self, ssr: ScaleSetResourceRequest,
+                          event: ResourceRequestUpdated):
+        ctx = self._ctx()
 
         # Load the resource adapter for this request
         try:
@@ -188,7 +582,7 @@ class AwsScaleSetUpdatedListener(AwsScaleSetListenerMixin, BaseListener):
             return
 
         try:
-            # Now create the scale set
+            # Now update the scale set
             adapter.update_scale_set(
                 name=ssr.id,
                 resourceAdapterProfile=ssr.resourceadapter_profile_name,
@@ -200,7 +594,7 @@ class AwsScaleSetUpdatedListener(AwsScaleSetListenerMixin, BaseListener):
         except Exception as ex:
             logger.error("Error updating resource request: %s", ex)
             old = self.get_previous_scale_set_request(event)
-            self._store.rollback(old)
+            ctx.store.rollback(old)
 
 
 class AwsScaleSetDeletedListener(AwsScaleSetListenerMixin, BaseListener):
@@ -208,6 +602,13 @@ class AwsScaleSetDeletedListener(AwsScaleSetListenerMixin, BaseListener):
     event_types = [ResourceRequestDeleted]
 
     def run(self, event: ResourceRequestDeleted):
+        try:
+            self._run(event)
+        finally:
+            self.close_session()
+
+    def _run(self, event: ResourceRequestDeleted):
+        ctx = self._ctx()
         #
         # If no scale set for AWS, then ignore this event
         #
@@ -215,7 +616,12 @@ class AwsScaleSetDeletedListener(AwsScaleSetListenerMixin, BaseListener):
         if ssr is None:
             return
 
-        logger.warning('Scale set delete request for AWS: %s', ssr.id)
+        logger.debug('Scale set delete request for AWS: %s', ssr.id)
+
+        # Drop any coalesced update that has not been applied yet; updating
+        # a scale set that is being deleted would fail and roll back the
+        # deleted resource request
+        _update_coalescer.cancel(ssr.id)
 
         # Load the resource adapter for this request
         try:
@@ -232,13 +638,17 @@ class AwsScaleSetDeletedListener(AwsScaleSetListenerMixin, BaseListener):
                 adapter_args=ssr.adapter_arguments
             )
         except botocore.exceptions.ClientError as ex:
-            # Check for "not found" exception by parsing response string. If
-            # that is the case, the auto scaling group doesn't exist and there
-            # is no need to roll back the deletion request
-            response_msg = ex.response.get("Error", {}).get("Message", "")
-            if not "AutoScalingGroup name not found" in response_msg:
+            # Check for "not found" exception. AWS reports it as a generic
+            # ValidationError, so the error code alone is not enough and the
+            # message is checked too. If that is the case, the auto scaling
+            # group doesn't exist and there is no need to roll back the
+            # deletion request
+            error = ex.response.get("Error", {})
+            if error.get("Code") != "ValidationError" or \
+                    "AutoScalingGroup name not found" not in \
+                    error.get("Message", ""):
                 logger.exception("Error deleting resource request: %s", ex)
-                self._store.rollback(ssr)
+                ctx.store.rollback(ssr)
         except Exception as ex:
             logger.exception("Error deleting resource request: %s", ex)
-            self._store.rollback(ssr)
+            ctx.store.rollback(ssr)